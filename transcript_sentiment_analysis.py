@@ -6,7 +6,7 @@
 # MAGIC
 # MAGIC ## 分析の流れ
 # MAGIC 1. **文字起こしファイルの読み込み** - タイムスタンプ付き文字起こしを解析
-# MAGIC 2. **感情分析（並列処理）** - Claude Sonnet 4.5で各発話の感情をSpark UDFで並列分析
+# MAGIC 2. **感情分析（並列処理）** - Claude Sonnet 4.5で各発話の感情を複数発話ずつまとめてmapInPandasで並列分析
 # MAGIC 3. **発話者別可視化** - 時系列推移、感情分布、スコア分布を発話者別に表示
 # MAGIC 4. **感情変動分析** - 急激な感情変化とその原因となった発話を特定
 # MAGIC 5. **影響力分析** - どの発話者が他者の感情に最も影響を与えているか分析
@@ -14,7 +14,7 @@
 # MAGIC ## 主な機能
 # MAGIC - ✅ タイムスタンプ付き文字起こしの自動パース
 # MAGIC - ✅ Claude Sonnet 4.5による高精度な感情分析
-# MAGIC - ✅ Spark UDFによる並列処理で高速化
+# MAGIC - ✅ mapInPandasによるバッチ並列処理で高速化
 # MAGIC - ✅ Plotlyによるインタラクティブな可視化
 # MAGIC - ✅ 発話者間の感情的影響関係の特定
 
@@ -25,7 +25,7 @@
 
 # COMMAND ----------
 
-# MAGIC %pip install mlflow pandas plotly
+# MAGIC %pip install requests pandas plotly
 
 # COMMAND ----------
 
@@ -35,24 +35,52 @@ dbutils.library.restartPython()
 
 import os
 import json
+import mmap
 import re
+import sys
+import types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional
 
-from mlflow.deployments import get_deploy_client
-import mlflow
+import requests
+from requests.adapters import HTTPAdapter
 
 import pandas as pd
+from pyspark.sql import DataFrame
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType
 import plotly.express as px
 import plotly.graph_objects as go
 
-# クライアント初期化
-fm_client = get_deploy_client("databricks")
+# サービングエンドポイントの接続情報（エグゼキューターへ一度だけブロードキャスト）
+ENDPOINT_NAME = "databricks-claude-sonnet-4-5"
+_notebook_context = dbutils.notebook.entry_point.getDbutils().notebook().getContext()
+ENDPOINT_CONFIG = spark.sparkContext.broadcast({
+    "url": f"{_notebook_context.apiUrl().get()}/serving-endpoints/{ENDPOINT_NAME}/invocations",
+    "token": _notebook_context.apiToken().get()
+})
 
 # 出力先
 OUTPUT_VOLUME = "/Volumes/takaakiyayoi_catalog/movie_analysis/movie_data"
 dbutils.fs.mkdirs(OUTPUT_VOLUME)
 
+# 感情分析結果のキャッシュ（テキストのSHA-256をキーに再分析を省略）
+EMOTION_CACHE_TABLE = "takaakiyayoi_catalog.movie_analysis.emotion_cache"
+spark.sql(f"""
+    CREATE TABLE IF NOT EXISTS {EMOTION_CACHE_TABLE} (
+        text_hash STRING,
+        emotion STRING,
+        sentiment_score DOUBLE,
+        confidence DOUBLE
+    ) USING DELTA
+""")
+
+# 感情分析結果の保存先（Deltaテーブル）
+EMOTION_RESULTS_TABLE = "takaakiyayoi_catalog.movie_analysis.emotion_results"
+
+# キャッシュとの結合で偏りが出ても適応的に最適化されるようにする
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+
 print("✅ セットアップ完了")
 
 # COMMAND ----------
@@ -79,12 +107,16 @@ print("✅ セットアップ完了")
 # COMMAND ----------
 
 dbutils.widgets.text("transcript_filename", "transcript_sample.txt", "文字起こしファイル名")
+dbutils.widgets.text("rps_budget", "32", "エンドポイントへの同時リクエスト上限")
 
 # COMMAND ----------
 
 transcript_filename = dbutils.widgets.get("transcript_filename")
 transcript_path = f"{OUTPUT_VOLUME}/{transcript_filename}"
 
+# クラスター全体でエンドポイントに同時に送るリクエスト数の上限
+RPS_BUDGET = int(dbutils.widgets.get("rps_budget"))
+
 print(f"🎯 分析対象: {transcript_path}")
 
 # ファイルの存在確認
@@ -110,82 +142,79 @@ except Exception as e:
 
 # COMMAND ----------
 
-def load_transcript_from_file(transcript_path: str) -> List[Dict]:
+# [名前] HH:MM:SS 形式のタイムスタンプ行と、その次の行（発話内容）を1回の走査で抽出
+# 全角スペースや全角数字も扱えるよう、デコード済みの文字列に対して走査する
+_SEGMENT_RE = re.compile(
+    r'^[^\S\n]*\[([^\]\n]+)\][^\S\n]+(\d{2}):(\d{2}):(\d{2})[^\n]*(?:\n([^\n]*))?',
+    re.MULTILINE
+)
+
+# これより大きいファイルはmmapで読み込み、バイト列のコピーを作らずにマッピングから直接デコードする
+MMAP_THRESHOLD_BYTES = 100 * 1024 * 1024
+
+# セグメントのスキーマ（Sparkに型推論させずに取り込む）
+SEGMENT_SCHEMA = StructType([
+    StructField("start", LongType(), False),
+    StructField("end", LongType(), False),
+    StructField("speaker", StringType(), False),
+    StructField("text", StringType(), False)
+])
+
+def _iter_segments(data: str) -> Iterator[Dict]:
+    """文字起こしの文字列を走査し、セグメントを1件ずつ生成"""
+    # 終了時間は次のタイムスタンプで決まるため、1件分だけ先読みしてから出力する
+    previous = None
+    for match in _SEGMENT_RE.finditer(data):
+        start_time = int(match.group(2)) * 3600 + int(match.group(3)) * 60 + int(match.group(4))
+
+        if previous is not None and previous["text"]:
+            yield {"start": previous["start"], "end": start_time, "speaker": previous["speaker"], "text": previous["text"]}
+
+        previous = {
+            "start": start_time,
+            "speaker": match.group(1),
+            "text": (match.group(5) or '').strip()
+        }
+
+    # 最後の発話はデフォルト30秒
+    if previous is not None and previous["text"]:
+        yield {"start": previous["start"], "end": previous["start"] + 30, "speaker": previous["speaker"], "text": previous["text"]}
+
+def stream_transcript(transcript_path: str) -> Iterator[Dict]:
     """
-    文字起こしファイルを読み込んでセグメントに分割
+    文字起こしファイルを読み込み、セグメントを1件ずつ生成
 
     フォーマット想定:
     [名前] HH:MM:SS
     テキスト内容
     """
-    print(f"📄 文字起こしファイル読み込み: {transcript_path}")
+    with open(transcript_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                text = str(data, 'utf-8')
+        else:
+            text = f.read().decode('utf-8')
 
-    try:
-        with open(transcript_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        segments = []
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-
-            # [名前] HH:MM:SS 形式をパース
-            timestamp_match = re.match(r'\[([^\]]+)\]\s+(\d{2}):(\d{2}):(\d{2})', line)
-
-            if timestamp_match:
-                speaker = timestamp_match.group(1)
-                hours = int(timestamp_match.group(2))
-                minutes = int(timestamp_match.group(3))
-                seconds = int(timestamp_match.group(4))
-                start_time = hours * 3600 + minutes * 60 + seconds
-
-                # 次の行がテキスト内容
-                i += 1
-                if i < len(lines):
-                    text = lines[i].strip()
-
-                    if text:
-                        # 次のタイムスタンプを探して終了時間を設定
-                        end_time = start_time + 30  # デフォルト30秒
-                        for j in range(i + 1, len(lines)):
-                            next_line = lines[j].strip()
-                            next_match = re.match(r'\[([^\]]+)\]\s+(\d{2}):(\d{2}):(\d{2})', next_line)
-                            if next_match:
-                                next_hours = int(next_match.group(2))
-                                next_minutes = int(next_match.group(3))
-                                next_seconds = int(next_match.group(4))
-                                end_time = next_hours * 3600 + next_minutes * 60 + next_seconds
-                                break
-
-                        segments.append({
-                            "start": start_time,
-                            "end": end_time,
-                            "speaker": speaker,
-                            "text": text
-                        })
-
-            i += 1
-
-        print(f"✅ 読み込み完了: {len(segments)}セグメント")
-        return segments
+    # バイナリモードでは改行コードが変換されないため、テキストモードと同様に\r\n・\rを\nに揃える
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
 
-    except Exception as e:
-        print(f"❌ エラー: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+    yield from _iter_segments(text)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## 4. 感情分析（Spark UDFによる並列処理）
+# MAGIC ## 4. 感情分析（mapInPandasによるバッチ並列処理）
 # MAGIC
 # MAGIC ### 使用モデル
 # MAGIC - **Claude Sonnet 4.5** (`databricks-claude-sonnet-4-5`)
 # MAGIC
 # MAGIC ### 処理方式
-# MAGIC - Spark UDFで各セグメントを並列処理
-# MAGIC - クラスターのリソースを活用して高速分析
+# MAGIC - `mapInPandas`で各タスクにpandasチャンク単位でセグメントを割り当て
+# MAGIC - 長さの近いセグメントをまとめ、トークン数の上限（約4000）または16件に達するまで1つのプロンプトに詰めて1リクエストで分析
+# MAGIC - 各タスク内ではスレッドプールで複数リクエストを同時に発行（全タスク合計でウィジェット`rps_budget`の同時リクエスト数まで）
+# MAGIC - 「はい」「ありがとうございます」などの定型的な短い発話は辞書で判定し、LLMには送信しない（辞書による判定はキャッシュせず毎回やり直す）
+# MAGIC - 分析結果はテキストのハッシュをキーにDeltaテーブルへキャッシュし、再実行時は未分析のテキストのみLLMに送信
+# MAGIC - リクエスト数を削減し、クラスターのリソースを活用して高速分析
 # MAGIC
 # MAGIC ### 分析内容
 # MAGIC 各発話について以下を分析：
@@ -195,97 +224,315 @@ def load_transcript_from_file(transcript_path: str) -> List[Dict]:
 
 # COMMAND ----------
 
-def analyze_emotion(text: str, timestamp: float) -> Dict:
+# 1リクエストにまとめるセグメント数の上限
+BATCH_SIZE = 16
+# 1リクエストにまとめる入力トークン数の目安（文字数÷3で概算）
+TOKEN_BUDGET = 4000
+
+def _get_session(pool_size: Optional[int] = None) -> requests.Session:
+    """
+    接続プール付きのHTTPセッションを遅延生成して返す（ワーカープロセス内で共有）
+
+    pool_sizeを指定した場合は接続プールをその大きさに合わせ、省略時は現在のプールをそのまま使う
+    """
+    # ノートブックで定義した関数はタスクごとに新しいグローバル変数で復元されるため、
+    # タスクをまたいで残るようsys.modulesに登録したモジュールにセッションを保持する
+    holder = sys.modules.setdefault("_emotion_session_holder", types.ModuleType("_emotion_session_holder"))
+    sessions = holder.__dict__.setdefault("sessions", {})
+
+    # 再実行でトークンが変わった場合は新しいセッションを作成
+    token = ENDPOINT_CONFIG.value['token']
+    session, current_size = sessions.get(token, (None, None))
+    if session is None:
+        session = requests.Session()
+        session.headers.update({"Authorization": f"Bearer {token}"})
+
+    # 同時リクエスト数が変わった場合はプールを作り直し、スレッド数分の接続を保持できるようにする
+    if current_size is None or (pool_size is not None and pool_size != current_size):
+        current_size = pool_size or 32
+        # 同時リクエスト間でTCP/TLS接続を再利用
+        session.mount("https://", HTTPAdapter(pool_connections=current_size, pool_maxsize=current_size))
+        sessions[token] = (session, current_size)
+    return session
+
+def invoke_endpoint(inputs: Dict) -> Dict:
+    """サービングエンドポイントを呼び出してレスポンスを返す"""
+    response = _get_session().post(ENDPOINT_CONFIG.value['url'], json=inputs, timeout=120)
+    response.raise_for_status()
+    return response.json()
+
+# 入力・出力トークン数を抑えるため、プロンプトは最小限にする
+SYSTEM_PROMPT = "感情分析器。JSONのみ出力。"
+# 1発言あたりに送るテキストの最大文字数
+MAX_TEXT_CHARS = 500
+
+# LLMを使わずに判定できる定型的な短い発話と感情スコア（前後の空白・句読点を除いて完全一致）
+LEXICON = {
+    "はい": 0.0,
+    "うん": 0.0,
+    "ええ": 0.0,
+    "そうですね": 0.0,
+    "なるほど": 0.0,
+    "了解です": 0.0,
+    "わかりました": 0.0,
+    "よろしくお願いします": 0.3,
+    "いいですね": 0.7,
+    "ありがとう": 0.8,
+    "ありがとうございます": 0.8,
+    "ありがとうございました": 0.8,
+    "嬉しい": 0.9,
+    "素晴らしい": 0.9,
+    "最高": 0.9,
+    "すみません": -0.2,
+    "申し訳ありません": -0.3,
+    "残念です": -0.6,
+    "困ります": -0.6,
+    "最悪": -0.8
+}
+LEXICON_STRIP_CHARS = " \t\u3000。、．，！!？?…"
+
+def analyze_emotion(text: str) -> Dict:
     """感情分析"""
-    prompt = f"""発言（{timestamp//60:.0f}分{timestamp%60:.0f}秒）の感情を分析:
+    prompt = f"""感情を分析: {text[:MAX_TEXT_CHARS]}
+JSON: {{"emotion":"ポジティブ|ネガティブ|中立","sentiment_score":-1〜1,"confidence":0〜1}}"""
+
+    try:
+        response = invoke_endpoint({
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.1,
+            # JSONオブジェクト1つ分（約40トークン）で打ち切る
+            "max_tokens": 64,
+            "stop": ["}"],
+            # 構造化出力でJSONオブジェクトのみを返させる
+            "response_format": {"type": "json_object"}
+        })
+
+        result_text = response['choices'][0]['message']['content']
+        # 停止シーケンスの"}"は出力に含まれないため補う
+        if not result_text.rstrip().endswith('}'):
+            result_text = result_text.rstrip() + '}'
+        return json.loads(result_text)
+    except Exception as e:
+        print(f"   分析エラー: {e}")
+        return {"emotion": "中立", "sentiment_score": 0.0, "confidence": 0.0}
+
+def analyze_emotion_batch(texts: List[str]) -> List[Dict]:
+    """
+    複数の発言をまとめて感情分析（1リクエストで処理）
 
-{text}
+    発言に番号を振った1つのプロンプトを送り、番号付きの結果配列をJSONオブジェクトで受け取る。
+    応答のパースに失敗した発言は中立として扱う。
+    """
+    if len(texts) == 1:
+        return [analyze_emotion(texts[0])]
 
-JSON形式で回答してください:
-{{
-    "emotion": "ポジティブ/ネガティブ/中立",
-    "sentiment_score": -1.0〜1.0,
-    "confidence": 0.0〜1.0
-}}"""
+    numbered = "\n".join(f"{i}. {text[:MAX_TEXT_CHARS]}" for i, text in enumerate(texts, start=1))
+    prompt = f"""各発言の感情を分析:
+{numbered}
+JSON: {{"results":[{{"i":番号,"emotion":"ポジティブ|ネガティブ|中立","sentiment_score":-1〜1,"confidence":0〜1}}, ...]}}"""
 
     try:
-        response = fm_client.predict(
-            endpoint="databricks-claude-sonnet-4-5",
-            inputs={
-                "messages": [
-                    {"role": "system", "content": "あなたは感情分析の専門家です。テキストの感情を正確に分析してJSON形式で返してください。"},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 300
-            }
-        )
+        response = invoke_endpoint({
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.1,
+            # 1発言あたりJSONオブジェクト1つ分（約40トークン）に余裕を持たせ、外側の{"results":[...]}の分を加える
+            "max_tokens": 32 + 64 * len(texts),
+            # 構造化出力でJSONオブジェクトのみを返させる
+            "response_format": {"type": "json_object"}
+        })
 
         result_text = response['choices'][0]['message']['content']
-        json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
 
-        if json_match:
-            return json.loads(json_match.group())
-        else:
-            return {"emotion": "中立", "sentiment_score": 0.0, "confidence": 0.5}
+        results = {}
+        for item in json.loads(result_text).get('results', []):
+            if isinstance(item, dict) and 'i' in item:
+                results[int(item['i'])] = item
+
+        # 番号で元の順序に揃え、欠けた発言は中立とする
+        return [
+            results.get(i, {"emotion": "中立", "sentiment_score": 0.0, "confidence": 0.0})
+            for i in range(1, len(texts) + 1)
+        ]
     except Exception as e:
         print(f"   分析エラー: {e}")
-        return {"emotion": "中立", "sentiment_score": 0.0, "confidence": 0.0}
+        return [{"emotion": "中立", "sentiment_score": 0.0, "confidence": 0.0} for _ in texts]
+
+def analyze_all_segments(
+    segments_df: DataFrame,
+    batch_size: int = BATCH_SIZE,
+    token_budget: int = TOKEN_BUDGET,
+    rps_budget: int = RPS_BUDGET
+) -> DataFrame:
+    """
+    全セグメント分析（キャッシュ未登録のテキストのみmapInPandasでまとめて並列化）
+
+    結果はEMOTION_RESULTS_TABLEに保存し、そのテーブルをSparkデータフレームとして返す
+    """
+    print(f"🧠 感情分析: {segments_df.count()}セグメント（並列処理・最大{batch_size}件/リクエスト）")
 
-def analyze_all_segments(segments: List[Dict]) -> pd.DataFrame:
-    """全セグメント分析（Spark UDFで並列化）"""
-    print(f"🧠 感情分析: {len(segments)}セグメント（並列処理）")
+    from pyspark.sql.functions import broadcast, col, floor, least, length, lit, regexp_replace, sha2, when
 
-    # PandasデータフレームをSparkデータフレームに変換
-    segments_df = spark.createDataFrame(pd.DataFrame(segments))
+    # テキストのハッシュを付与
+    segments_df = segments_df.withColumn("text_hash", sha2(col("text"), 256))
+
+    # 辞書に一致する発話はSpark上で判定し、LLMに送る件数やタスク数の見積もりから除外する
+    # （キャッシュより先に判定し、辞書の変更が過去にキャッシュした発話にも反映されるようにする）
+    strip_chars = re.escape(LEXICON_STRIP_CHARS)
+    lexicon_df = spark.createDataFrame(
+        [(key, float(score)) for key, score in LEXICON.items()], "lexicon_key STRING, lexicon_score DOUBLE"
+    )
+    texts_df = (
+        segments_df
+        .dropDuplicates(["text_hash"])
+        .withColumn("lexicon_key", regexp_replace("text", f"^[{strip_chars}]+|[{strip_chars}]+$", ""))
+        .join(broadcast(lexicon_df), "lexicon_key", "left")
+    )
+    lexicon_hits_df = (
+        texts_df
+        .filter(col("lexicon_score").isNotNull())
+        .select(
+            "text_hash",
+            when(col("lexicon_score") > 0, "ポジティブ").when(col("lexicon_score") < 0, "ネガティブ").otherwise("中立").alias("emotion"),
+            col("lexicon_score").alias("sentiment_score"),
+            lit(1.0).alias("confidence")
+        )
+    )
 
-    # UDF定義（感情分析）
-    from pyspark.sql.functions import udf, struct
-    from pyspark.sql.types import StructType, StructField, StringType, DoubleType
+    # 辞書に一致せず、キャッシュにもないテキストのみをLLMで分析する（同じテキストは1回だけ分析）
+    cached_df = spark.table(EMOTION_CACHE_TABLE)
+    pending_df = (
+        texts_df
+        .filter(col("lexicon_score").isNull())
+        .join(cached_df, "text_hash", "left_anti")
+        .select("text_hash", "text", floor(least(length("text"), lit(MAX_TEXT_CHARS)) / 3).alias("approx_tokens"))
+    )
+    n_pending = pending_df.count()
+    print(f"   キャッシュ未登録: {n_pending}件（LLMで分析）")
 
-    # 戻り値のスキーマ定義
+    # 戻り値のスキーマ定義（キャッシュテーブルと同じ列構成）
     emotion_schema = StructType([
+        StructField("text_hash", StringType(), True),
         StructField("emotion", StringType(), True),
-        StructField("sentiment_score", DoubleType(), True)
+        StructField("sentiment_score", DoubleType(), True),
+        StructField("confidence", DoubleType(), True)
     ])
 
-    def analyze_emotion_udf(text: str, timestamp: float) -> dict:
-        """UDF用の感情分析関数"""
+    def to_emotion_row(emotion: Dict) -> tuple:
+        """分析結果を(感情ラベル, スコア, 信頼度)に正規化"""
         try:
-            emotion = analyze_emotion(text, timestamp)
-            return {
-                "emotion": emotion.get('emotion', '中立'),
-                "sentiment_score": float(emotion.get('sentiment_score', 0.0))
-            }
+            return (
+                emotion.get('emotion', '中立'),
+                float(emotion.get('sentiment_score', 0.0)),
+                float(emotion.get('confidence', 0.0))
+            )
         except Exception as e:
             print(f"分析エラー: {e}")
-            return {"emotion": "中立", "sentiment_score": 0.0}
-
-    # UDF登録
-    emotion_udf = udf(analyze_emotion_udf, emotion_schema)
+            return "中立", 0.0, 0.0
+
+    def pack_chunks(pdf: pd.DataFrame) -> List[pd.DataFrame]:
+        """
+        長さ順に並べたセグメントを、トークン数の上限かbatch_size件に達するまで貪欲に詰める
+
+        長さの近いセグメント同士をまとめることで、長い発言1件にバッチ全体の入力が引きずられるのを防ぐ
+        """
+        pdf = pdf.sort_values('approx_tokens', kind='stable')
+        chunks = []
+        start, total_tokens = 0, 0
+        for i, tokens in enumerate(pdf['approx_tokens']):
+            if i > start and (total_tokens + tokens > token_budget or i - start >= batch_size):
+                chunks.append(pdf.iloc[start:i])
+                start, total_tokens = i, 0
+            total_tokens += tokens
+        if start < len(pdf):
+            chunks.append(pdf.iloc[start:])
+        return chunks
+
+    def analyze_chunk(chunk: pd.DataFrame) -> List[tuple]:
+        """詰め込んだチャンクを1リクエストで分析"""
+        emotions = analyze_emotion_batch(chunk['text'].tolist())
+        return [to_emotion_row(emotion) for emotion in emotions]
+
+    # リクエスト数（batch_size件単位で概算）と同時リクエスト上限の小さい方をタスク数とし、
+    # 上限を同時に実行されるタスク間で分け合うことでエンドポイントを飽和させつつ超過しないようにする
+    n_partitions = max(1, min((n_pending + batch_size - 1) // batch_size, rps_budget))
+    # クラスタのコア数を超えるタスクは順番待ちになるため、同時実行数はコア数で頭打ちになる
+    concurrent_tasks = min(n_partitions, spark.sparkContext.defaultParallelism)
+    max_concurrency = max(1, rps_budget // concurrent_tasks)
+    print(f"   タスク数: {n_partitions}（同時実行{concurrent_tasks}タスク・各タスク最大{max_concurrency}並列）")
+
+    def analyze_partition(batches):
+        """pandasチャンクをリクエスト単位に詰め直し、スレッドプールで同時にリクエスト"""
+        # スレッドから共有する前にHTTPセッションを生成しておく
+        _get_session(max_concurrency)
+
+        # I/O待ちが支配的なため、タスク内でリクエストを並行発行してエンドポイント側のバッチ処理を活用
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for pdf in batches:
+                chunks = pack_chunks(pdf)
+
+                # executor.mapは入力順に結果を返すため、詰め直した順序のハッシュと対応する
+                rows = [row for chunk_rows in executor.map(analyze_chunk, chunks) for row in chunk_rows]
+                text_hashes = [text_hash for chunk in chunks for text_hash in chunk['text_hash']]
+
+                yield pd.DataFrame({
+                    "text_hash": text_hashes,
+                    "emotion": [emotion for emotion, _, _ in rows],
+                    "sentiment_score": [score for _, score, _ in rows],
+                    "confidence": [confidence for _, _, confidence in rows]
+                })
+
+    # キャッシュ登録と結果の結合で2回参照するため、LLM呼び出しが1回で済むよう永続化
+    # 長さで範囲分割し、各タスクに長さの近いセグメントが集まるようにする
+    # （同じ長さのセグメントが1タスクに偏らないよう、ハッシュで同じ長さの範囲も分割する）
+    analyzed_df = (
+        pending_df
+        .repartitionByRange(n_partitions, "approx_tokens", "text_hash")
+        .mapInPandas(analyze_partition, schema=emotion_schema)
+        .cache()
+    )
 
-    # UDFを適用
-    result_df = segments_df.withColumn(
-        "emotion_result",
-        emotion_udf(segments_df.text, segments_df.start)
+    # 辞書による判定、キャッシュ済みの結果（辞書に一致したテキストを除く）、新たな分析結果を各セグメントに結合
+    known_df = lexicon_hits_df.unionByName(cached_df.join(lexicon_hits_df.select("text_hash"), "text_hash", "left_anti"))
+    result_df = (
+        segments_df
+        .join(known_df.unionByName(analyzed_df), "text_hash")
+        .select(
+            col("start").alias("start_time"),
+            col("end").alias("end_time"),
+            "speaker",
+            "text",
+            "emotion",
+            "sentiment_score"
+        )
     )
 
-    # 結果を展開
-    result_df = result_df.select(
-        "start",
-        "end",
-        "speaker",
-        "text",
-        result_df.emotion_result.emotion.alias("emotion"),
-        result_df.emotion_result.sentiment_score.alias("sentiment_score")
+    # ドライバーに集約せず、Deltaテーブルに直接書き込む
+    (
+        result_df.write
+        .mode("overwrite")
+        .option("overwriteSchema", "true")
+        .saveAsTable(EMOTION_RESULTS_TABLE)
     )
 
-    # Pandasデータフレームに変換して返す
-    result_pdf = result_df.toPandas()
-    result_pdf = result_pdf.rename(columns={"start": "start_time", "end": "end_time"})
+    # LLMによる新たな分析結果のみキャッシュに登録する
+    # （辞書による判定は辞書の変更を反映するため毎回やり直し、エラー時のフォールバック結果は信頼度0のため登録しない）
+    analyzed_df.filter(col("confidence") > 0).createOrReplaceTempView("emotion_cache_updates")
+    spark.sql(f"""
+        MERGE INTO {EMOTION_CACHE_TABLE} AS cache
+        USING emotion_cache_updates AS updates
+        ON cache.text_hash = updates.text_hash
+        WHEN NOT MATCHED THEN INSERT *
+    """)
+    analyzed_df.unpersist()
 
-    print("✅ 完了")
-    return result_pdf
+    print(f"✅ 完了: {EMOTION_RESULTS_TABLE}")
+    return spark.table(EMOTION_RESULTS_TABLE)
 
 # COMMAND ----------
 
@@ -296,7 +543,7 @@ def analyze_all_segments(segments: List[Dict]) -> pd.DataFrame:
 # MAGIC ファイルからセグメントデータを抽出
 # MAGIC
 # MAGIC ### Step 2: 感情分析
-# MAGIC 全セグメントを並列処理で分析
+# MAGIC 全セグメントを並列処理で分析し、結果をDeltaテーブルに保存
 # MAGIC
 # MAGIC ### Step 3〜5: 可視化
 # MAGIC - **時系列推移グラフ** - 発話者別に色分けした感情スコアの推移
@@ -307,14 +554,23 @@ def analyze_all_segments(segments: List[Dict]) -> pd.DataFrame:
 
 # COMMAND ----------
 
-# Step 1: 文字起こしファイルを読み込み
-segments = load_transcript_from_file(transcript_path)
-display(pd.DataFrame(segments).head(20))
+# Step 1: 文字起こしファイルを読み込み（パースした順にスキーマ指定でSparkデータフレームへ取り込む）
+print(f"📄 文字起こしファイル読み込み: {transcript_path}")
+segments_df = spark.createDataFrame(stream_transcript(transcript_path), SEGMENT_SCHEMA)
+print(f"✅ 読み込み完了: {segments_df.count()}セグメント")
+display(segments_df.limit(20))
 
 # COMMAND ----------
 
-# Step 2: 感情分析
-emotion_df = analyze_all_segments(segments)
+# Step 2: 感情分析（結果はDeltaテーブルに保存）
+emotion_sdf = analyze_all_segments(segments_df)
+
+# 発話単位の可視化と感情変動分析に使うため、時系列順にPandasへ変換
+emotion_df = emotion_sdf.orderBy("start_time").toPandas()
+
+# 値の種類が少ない列はカテゴリ型にして、グループ化・比較を高速化しメモリを削減
+emotion_df['speaker'] = emotion_df['speaker'].astype('category')
+emotion_df['emotion'] = emotion_df['emotion'].astype('category')
 display(emotion_df)
 
 # COMMAND ----------
@@ -324,23 +580,19 @@ display(emotion_df)
 # 感情の推移をプロット（発話者別）
 fig = go.Figure()
 
-# 発話者ごとに色分けしてプロット
-speakers = emotion_df['speaker'].unique()
+# 発話者ごとに色分けしてプロット（1回のグループ化で発話者別に分割）
 colors = px.colors.qualitative.Plotly
 
-for i, speaker in enumerate(speakers):
-    speaker_data = emotion_df[emotion_df['speaker'] == speaker]
-
+for i, (speaker, speaker_data) in enumerate(emotion_df.groupby('speaker', sort=False, observed=True)):
     fig.add_trace(go.Scatter(
-        x=speaker_data['start_time'],
-        y=speaker_data['sentiment_score'],
+        x=speaker_data['start_time'].values,
+        y=speaker_data['sentiment_score'].values,
         mode='lines+markers',
         name=speaker,
         line=dict(color=colors[i % len(colors)], width=2),
         marker=dict(size=8),
-        hovertemplate='<b>発話者</b>: ' + speaker + '<br><b>時間</b>: %{x}秒<br><b>スコア</b>: %{text}<br><b>テキスト</b>: %{customdata}<extra></extra>',
-        text=[f"{score:.2f}" for score in speaker_data['sentiment_score']],
-        customdata=speaker_data['text']
+        hovertemplate='<b>発話者</b>: ' + speaker + '<br><b>時間</b>: %{x}秒<br><b>スコア</b>: %{y:.2f}<br><b>テキスト</b>: %{customdata}<extra></extra>',
+        customdata=speaker_data['text'].values
     ))
 
 # ゼロラインを追加
@@ -434,6 +686,9 @@ emotion_color_map = {
 # 順序を固定（ポジティブ、中立、ネガティブ）
 emotion_order = ['ポジティブ', '中立', 'ネガティブ']
 
+# 発話者×感情の件数を一括で集計
+speaker_emotion_counts = pd.crosstab(emotion_df['speaker'], emotion_df['emotion'])
+
 # サブプロットの行列数を計算
 cols = min(3, n_speakers)
 rows = (n_speakers + cols - 1) // cols
@@ -446,8 +701,8 @@ fig2_speaker = make_subplots(
 )
 
 for i, speaker in enumerate(speakers):
-    speaker_data = emotion_df[emotion_df['speaker'] == speaker]
-    emotion_counts_speaker = speaker_data['emotion'].value_counts()
+    emotion_counts_speaker = speaker_emotion_counts.loc[speaker]
+    emotion_counts_speaker = emotion_counts_speaker[emotion_counts_speaker > 0]
 
     row = i // cols + 1
     col = i % cols + 1
@@ -540,7 +795,7 @@ fig5.show()
 # COMMAND ----------
 
 # Step 5-4: 発話者別の平均感情スコア（棒グラフ）
-speaker_avg = emotion_df.groupby('speaker')['sentiment_score'].mean().reset_index()
+speaker_avg = emotion_df.groupby('speaker', observed=True)['sentiment_score'].mean().reset_index()
 speaker_avg = speaker_avg.sort_values('sentiment_score', ascending=False)
 
 fig6 = px.bar(
@@ -593,56 +848,52 @@ def analyze_emotion_changes(emotion_df: pd.DataFrame, threshold: float = 0.3) ->
     Returns:
         感情変動の分析結果
     """
-    changes = []
-
-    # 発話者ごとに分析
-    for speaker in emotion_df['speaker'].unique():
-        speaker_data = emotion_df[emotion_df['speaker'] == speaker].sort_values('start_time').reset_index(drop=True)
-
-        for i in range(1, len(speaker_data)):
-            current = speaker_data.iloc[i]
-            previous = speaker_data.iloc[i-1]
-
-            # 感情スコアの変化量を計算
-            score_change = current['sentiment_score'] - previous['sentiment_score']
-
-            # 閾値を超える変動があった場合
-            if abs(score_change) >= threshold:
-                # その間に他の発話者の発言を探す
-                between_time_start = previous['start_time']
-                between_time_end = current['start_time']
-
-                # 他の発話者の発言を取得
-                other_speakers = emotion_df[
-                    (emotion_df['speaker'] != speaker) &
-                    (emotion_df['start_time'] > between_time_start) &
-                    (emotion_df['start_time'] < between_time_end)
-                ].sort_values('start_time')
-
-                if len(other_speakers) > 0:
-                    # 最も近い発言を特定
-                    trigger_utterance = other_speakers.iloc[-1]  # 直前の発言
-
-                    change_type = "改善" if score_change > 0 else "悪化"
-
-                    changes.append({
-                        "affected_speaker": speaker,
-                        "change_type": change_type,
-                        "score_change": score_change,
-                        "before_score": previous['sentiment_score'],
-                        "after_score": current['sentiment_score'],
-                        "before_time": previous['start_time'],
-                        "after_time": current['start_time'],
-                        "before_text": previous['text'],
-                        "after_text": current['text'],
-                        "trigger_speaker": trigger_utterance['speaker'],
-                        "trigger_time": trigger_utterance['start_time'],
-                        "trigger_text": trigger_utterance['text'],
-                        "trigger_emotion": trigger_utterance['emotion'],
-                        "trigger_score": trigger_utterance['sentiment_score']
-                    })
-
-    return pd.DataFrame(changes)
+    # 時系列順に並べ、発話者ごとに直前の発話を横に並べる
+    df = emotion_df.sort_values('start_time', kind='stable').reset_index(drop=True)
+    previous = df.groupby('speaker', sort=False, observed=True)[['sentiment_score', 'start_time', 'text']].shift(1)
+
+    score_change = df['sentiment_score'] - previous['sentiment_score']
+    changes = pd.DataFrame({
+        "affected_speaker": df['speaker'],
+        "change_type": score_change.gt(0).map({True: "改善", False: "悪化"}),
+        "score_change": score_change,
+        "before_score": previous['sentiment_score'],
+        "after_score": df['sentiment_score'],
+        "before_time": previous['start_time'],
+        "after_time": df['start_time'],
+        "before_text": previous['text'],
+        "after_text": df['text']
+    })
+
+    # 閾値を超える変動のみ抽出（各発話者の最初の発話は比較対象がないため除外される）
+    changes = changes[changes['score_change'].abs() >= threshold]
+    # shiftで生じた欠損は上の抽出で除外済みのため、時刻を元の型に戻す
+    changes = changes.astype({'before_time': df['start_time'].dtype})
+
+    # 変化後の発話より前にある最後の発言を、トリガー候補として結合
+    triggers = df[['speaker', 'start_time', 'text', 'emotion', 'sentiment_score']].rename(columns={
+        'speaker': 'trigger_speaker',
+        'start_time': 'trigger_time',
+        'text': 'trigger_text',
+        'emotion': 'trigger_emotion',
+        'sentiment_score': 'trigger_score'
+    })
+    changes = pd.merge_asof(
+        changes,
+        triggers,
+        left_on='after_time',
+        right_on='trigger_time',
+        direction='backward',
+        allow_exact_matches=False
+    )
+
+    # 変化前の発話より後にある他の発話者の発言のみをトリガーとする
+    changes = changes[
+        (changes['trigger_time'] > changes['before_time']) &
+        (changes['trigger_speaker'] != changes['affected_speaker'])
+    ]
+
+    return changes.reset_index(drop=True)
 
 # 感情変動を分析
 emotion_changes_df = analyze_emotion_changes(emotion_df, threshold=0.3)
@@ -697,7 +948,7 @@ if len(emotion_changes_df) > 0:
     # COMMAND ----------
 
     # Step 6-3: トリガー発話者の影響力分析
-    trigger_impact = emotion_changes_df.groupby('trigger_speaker').agg({
+    trigger_impact = emotion_changes_df.groupby('trigger_speaker', observed=True).agg({
         'score_change': ['count', 'mean', 'sum']
     }).reset_index()
 
@@ -732,6 +983,14 @@ if len(emotion_changes_df) > 0:
     # COMMAND ----------
 
     # Step 6-4: 重要な感情変動イベントの詳細表示
+
+    # 表示用の「分:秒」文字列を列単位でまとめて作成
+    for time_col in ['before_time', 'after_time', 'trigger_time']:
+        seconds = emotion_changes_df[time_col]
+        emotion_changes_df[time_col.replace('_time', '_mmss')] = (
+            (seconds // 60).astype(int).astype(str) + ':' + (seconds % 60).astype(int).map('{:02d}'.format)
+        )
+
     print("📊 重要な感情変動イベント")
     print("="*80)
 
@@ -742,17 +1001,17 @@ if len(emotion_changes_df) > 0:
         print("\n✅ 【感情改善イベント】（変化量上位5件）")
         print("-"*80)
 
-        for idx, row in improvements_top.iterrows():
-            print(f"\n影響を受けた人: {row['affected_speaker']}")
-            print(f"  変化: {row['before_score']:.2f} → {row['after_score']:.2f} (差分: {row['score_change']:+.2f})")
-            print(f"  時間: {int(row['before_time']//60)}:{int(row['before_time']%60):02d} → {int(row['after_time']//60)}:{int(row['after_time']%60):02d}")
+        for row in improvements_top.itertuples(index=False):
+            print(f"\n影響を受けた人: {row.affected_speaker}")
+            print(f"  変化: {row.before_score:.2f} → {row.after_score:.2f} (差分: {row.score_change:+.2f})")
+            print(f"  時間: {row.before_mmss} → {row.after_mmss}")
             print(f"\n  🔹 変化前の発言:")
-            print(f"    {row['before_text'][:100]}...")
-            print(f"\n  ⚡ トリガーとなった発言 ({row['trigger_speaker']}):")
-            print(f"    [{int(row['trigger_time']//60)}:{int(row['trigger_time']%60):02d}] {row['trigger_text'][:100]}...")
-            print(f"    感情: {row['trigger_emotion']} (スコア: {row['trigger_score']:.2f})")
+            print(f"    {row.before_text[:100]}...")
+            print(f"\n  ⚡ トリガーとなった発言 ({row.trigger_speaker}):")
+            print(f"    [{row.trigger_mmss}] {row.trigger_text[:100]}...")
+            print(f"    感情: {row.trigger_emotion} (スコア: {row.trigger_score:.2f})")
             print(f"\n  🔹 変化後の発言:")
-            print(f"    {row['after_text'][:100]}...")
+            print(f"    {row.after_text[:100]}...")
             print("-"*80)
 
     # 悪化イベント（スコア下降が大きい順）
@@ -762,17 +1021,17 @@ if len(emotion_changes_df) > 0:
         print("\n\n❌ 【感情悪化イベント】（変化量上位5件）")
         print("-"*80)
 
-        for idx, row in deteriorations_top.iterrows():
-            print(f"\n影響を受けた人: {row['affected_speaker']}")
-            print(f"  変化: {row['before_score']:.2f} → {row['after_score']:.2f} (差分: {row['score_change']:+.2f})")
-            print(f"  時間: {int(row['before_time']//60)}:{int(row['before_time']%60):02d} → {int(row['after_time']//60)}:{int(row['after_time']%60):02d}")
+        for row in deteriorations_top.itertuples(index=False):
+            print(f"\n影響を受けた人: {row.affected_speaker}")
+            print(f"  変化: {row.before_score:.2f} → {row.after_score:.2f} (差分: {row.score_change:+.2f})")
+            print(f"  時間: {row.before_mmss} → {row.after_mmss}")
             print(f"\n  🔹 変化前の発言:")
-            print(f"    {row['before_text'][:100]}...")
-            print(f"\n  ⚡ トリガーとなった発言 ({row['trigger_speaker']}):")
-            print(f"    [{int(row['trigger_time']//60)}:{int(row['trigger_time']%60):02d}] {row['trigger_text'][:100]}...")
-            print(f"    感情: {row['trigger_emotion']} (スコア: {row['trigger_score']:.2f})")
+            print(f"    {row.before_text[:100]}...")
+            print(f"\n  ⚡ トリガーとなった発言 ({row.trigger_speaker}):")
+            print(f"    [{row.trigger_mmss}] {row.trigger_text[:100]}...")
+            print(f"    感情: {row.trigger_emotion} (スコア: {row.trigger_score:.2f})")
             print(f"\n  🔹 変化後の発言:")
-            print(f"    {row['after_text'][:100]}...")
+            print(f"    {row.after_text[:100]}...")
             print("-"*80)
 
 # COMMAND ----------
@@ -786,9 +1045,10 @@ print(f"発話者数: {emotion_df['speaker'].nunique()}")
 print(f"\n感情分布:")
 print(emotion_df['emotion'].value_counts())
 
-print(f"\n平均感情スコア: {emotion_df['sentiment_score'].mean():.3f}")
-print(f"最高スコア: {emotion_df['sentiment_score'].max():.3f}")
-print(f"最低スコア: {emotion_df['sentiment_score'].min():.3f}")
+score_stats = emotion_df['sentiment_score'].agg(['mean', 'max', 'min'])
+print(f"\n平均感情スコア: {score_stats['mean']:.3f}")
+print(f"最高スコア: {score_stats['max']:.3f}")
+print(f"最低スコア: {score_stats['min']:.3f}")
 
 # ポジティブ/ネガティブの割合
 positive_pct = (emotion_df['sentiment_score'] > 0).sum() / len(emotion_df) * 100
@@ -804,12 +1064,20 @@ print("\n" + "="*60)
 print("📊 発話者別サマリー")
 print("="*60)
 
-for speaker in emotion_df['speaker'].unique():
-    speaker_data = emotion_df[emotion_df['speaker'] == speaker]
-    print(f"\n【{speaker}】")
-    print(f"  発話回数: {len(speaker_data)}")
-    print(f"  平均感情スコア: {speaker_data['sentiment_score'].mean():.3f}")
-    print(f"  感情分布: {dict(speaker_data['emotion'].value_counts())}")
+# 発話回数・平均スコアと感情分布をそれぞれ1回の集計で算出
+speaker_summary = emotion_df.groupby('speaker', sort=False, observed=True).agg(
+    n_utterances=('text', 'size'),
+    avg_score=('sentiment_score', 'mean')
+)
+speaker_emotion_dist = pd.crosstab(emotion_df['speaker'], emotion_df['emotion'])
+
+for row in speaker_summary.itertuples():
+    emotion_dist = speaker_emotion_dist.loc[row.Index].sort_values(ascending=False)
+    emotion_dist = {emotion: int(n) for emotion, n in emotion_dist.items() if n > 0}
+    print(f"\n【{row.Index}】")
+    print(f"  発話回数: {row.n_utterances}")
+    print(f"  平均感情スコア: {row.avg_score:.3f}")
+    print(f"  感情分布: {emotion_dist}")
 
 # COMMAND ----------
 
@@ -825,7 +1093,7 @@ for speaker in emotion_df['speaker'].unique():
 # MAGIC
 # MAGIC #### 🤖 感情分析
 # MAGIC - ✅ Claude Sonnet 4.5による高精度分析
-# MAGIC - ✅ Spark UDFによる並列処理（高速化）
+# MAGIC - ✅ mapInPandasによるバッチ並列処理（高速化）
 # MAGIC - ✅ 感情ラベル・スコア・信頼度の抽出
 # MAGIC
 # MAGIC #### 📊 基本可視化